@@ -5,79 +5,191 @@ This module handles loading and managing configuration for the KAG system.
 It supports loading from environment variables and configuration files.
 """
 
+import dataclasses
 import os
-import json
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Callable, Mapping, Tuple
 from functools import lru_cache
 
-from pydantic import BaseModel, Field
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is optional
+    orjson = None
+    import json
 
-class Settings(BaseModel):
+try:
+    from dotenv import dotenv_values
+except ImportError:  # pragma: no cover - python-dotenv is optional
+    dotenv_values = None
+
+
+def _parse_bool(value: Any) -> bool:
+    """Parse a boolean from an environment or config value."""
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return bool(value)
+
+
+# Maps each settings field to its environment variable and type coercion
+_ENV_MAP: Tuple[Tuple[str, str, Callable[[Any], Any]], ...] = (
+    ("host", "KAG_HOST", str),
+    ("port", "KAG_PORT", int),
+    ("model_path", "KAG_MODEL_PATH", str),
+    ("tensor_parallel_size", "KAG_TENSOR_PARALLEL_SIZE", int),
+    ("gpu_memory_utilization", "KAG_GPU_MEMORY_UTILIZATION", float),
+    ("max_model_len", "KAG_MAX_MODEL_LEN", int),
+    ("disable_custom_all_reduce", "KAG_DISABLE_CUSTOM_ALL_REDUCE", _parse_bool),
+    ("kv_cache_token_limit", "KAG_KV_CACHE_TOKEN_LIMIT", int),
+    ("kv_cache_cleanup_interval", "KAG_KV_CACHE_CLEANUP_INTERVAL", int),
+    ("chunk_size", "KAG_CHUNK_SIZE", int),
+    ("chunk_overlap", "KAG_CHUNK_OVERLAP", int),
+    ("load_knowledge_on_startup", "KAG_LOAD_KNOWLEDGE_ON_STARTUP", _parse_bool),
+    ("preload_encoders", "KAG_PRELOAD_ENCODERS", str),
+    ("session_timeout", "KAG_SESSION_TIMEOUT", int),
+    ("database_url", "KAG_DATABASE_URL", str),
+    ("auth_enabled", "KAG_AUTH_ENABLED", _parse_bool),
+    ("jwt_secret", "KAG_JWT_SECRET", str),
+    ("jwt_algorithm", "KAG_JWT_ALGORITHM", str),
+    ("jwt_expires_minutes", "KAG_JWT_EXPIRES_MINUTES", int),
+    ("log_level", "KAG_LOG_LEVEL", str),
+    ("log_format", "KAG_LOG_FORMAT", str),
+    ("openai_api_prefix", "KAG_OPENAI_API_PREFIX", str),
+)
+
+# Optional dotenv file read once when settings are first built
+_ENV_FILE = ".env"
+
+
+def _env_overrides(environ: Mapping[str, Optional[str]]) -> Dict[str, Any]:
+    """
+    Collect settings values set in an environment mapping.
+    
+    Args:
+        environ: Mapping of environment variable names to values
+        
+    Returns:
+        Dictionary of field names to raw values
+    """
+    overrides = {}
+    for name, env_var, _ in _ENV_MAP:
+        value = environ.get(env_var)
+        if value is not None:
+            overrides[name] = value
+    return overrides
+
+
+def _read_environ() -> Mapping[str, Optional[str]]:
+    """
+    Read the process environment, layered over the .env file if present.
+    
+    Returns:
+        Mapping of environment variable names to values
+    """
+    if dotenv_values is None or not os.path.isfile(_ENV_FILE):
+        return os.environ
+    
+    environ = dict(dotenv_values(_ENV_FILE, encoding="utf-8"))
+    environ.update(os.environ)
+    return environ
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class Settings:
     """Settings for the KAG system."""
     
     # Server settings
-    host: str = Field(default="0.0.0.0", env="KAG_HOST")
-    port: int = Field(default=11434, env="KAG_PORT")
+    host: str = "0.0.0.0"
+    port: int = 11434
     
     # Model settings
-    model_path: str = Field(default="./qwq", env="KAG_MODEL_PATH")
-    tensor_parallel_size: int = Field(default=2, env="KAG_TENSOR_PARALLEL_SIZE")
-    gpu_memory_utilization: float = Field(default=0.7, env="KAG_GPU_MEMORY_UTILIZATION")
-    max_model_len: int = Field(default=4096, env="KAG_MAX_MODEL_LEN")
-    disable_custom_all_reduce: bool = Field(default=True, env="KAG_DISABLE_CUSTOM_ALL_REDUCE")
+    model_path: str = "./qwq"
+    tensor_parallel_size: int = 2
+    gpu_memory_utilization: float = 0.7
+    max_model_len: int = 4096
+    disable_custom_all_reduce: bool = True
     
     # KV cache settings
-    kv_cache_token_limit: int = Field(default=8192, env="KAG_KV_CACHE_TOKEN_LIMIT")
-    kv_cache_cleanup_interval: int = Field(default=3600, env="KAG_KV_CACHE_CLEANUP_INTERVAL")
+    kv_cache_token_limit: int = 8192
+    kv_cache_cleanup_interval: int = 3600
     
     # Document processing settings
-    chunk_size: int = Field(default=512, env="KAG_CHUNK_SIZE")
-    chunk_overlap: int = Field(default=128, env="KAG_CHUNK_OVERLAP")
+    chunk_size: int = 512
+    chunk_overlap: int = 128
+    load_knowledge_on_startup: bool = True
+    preload_encoders: str = ""  # Comma-separated tokenizer models loaded at import
     
     # Session settings
-    session_timeout: int = Field(default=86400, env="KAG_SESSION_TIMEOUT")  # 24 hours
+    session_timeout: int = 86400  # 24 hours
     
     # Database settings
-    database_url: str = Field(default="sqlite:///kag.db", env="KAG_DATABASE_URL")
+    database_url: str = "sqlite:///kag.db"
     
     # Authentication settings
-    auth_enabled: bool = Field(default=True, env="KAG_AUTH_ENABLED")
-    jwt_secret: str = Field(default="your-secret-key", env="KAG_JWT_SECRET")
-    jwt_algorithm: str = Field(default="HS256", env="KAG_JWT_ALGORITHM")
-    jwt_expires_minutes: int = Field(default=60 * 24, env="KAG_JWT_EXPIRES_MINUTES")  # 24 hours
+    auth_enabled: bool = True
+    jwt_secret: str = "your-secret-key"
+    jwt_algorithm: str = "HS256"
+    jwt_expires_minutes: int = 60 * 24  # 24 hours
     
     # Logging settings
-    log_level: str = Field(default="INFO", env="KAG_LOG_LEVEL")
-    log_format: str = Field(default="%(asctime)s - %(name)s - %(levelname)s - %(message)s", env="KAG_LOG_FORMAT")
+    log_level: str = "INFO"
+    log_format: str = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
     
     # OpenAI API compatibility settings
-    openai_api_prefix: str = Field(default="/v1", env="KAG_OPENAI_API_PREFIX")
-    
-    class Config:
-        """Pydantic config."""
-        env_file = ".env"
-        env_file_encoding = "utf-8"
-        env_prefix = "KAG_"
-        case_sensitive = False
+    openai_api_prefix: str = "/v1"
+    
+    def __post_init__(self) -> None:
+        """Coerce values loaded from env or config files to their field types."""
+        for name, _, cast in _ENV_MAP:
+            value = getattr(self, name)
+            coerced = cast(value)
+            if coerced is not value:
+                object.__setattr__(self, name, coerced)
+    
+    @classmethod
+    def _from_env(
+        cls,
+        environ: Optional[Mapping[str, Optional[str]]] = None,
+        **overrides: Any
+    ) -> "Settings":
+        """
+        Build settings from environment variables.
         
+        Args:
+            environ: Environment mapping to read, defaults to os.environ
+            overrides: Values that take precedence over field defaults but
+                are themselves overridden by environment variables
+        
+        Returns:
+            Settings instance
+        """
+        values = {name: overrides[name] for name, _, _ in _ENV_MAP if name in overrides}
+        values.update(_env_overrides(os.environ if environ is None else environ))
+        return cls(**values)
+    
     def to_dict(self) -> Dict[str, Any]:
         """Convert settings to dictionary."""
-        return self.dict()
+        return dataclasses.asdict(self)
     
     def to_json(self) -> str:
         """Convert settings to JSON."""
+        if orjson is not None:
+            return orjson.dumps(self.to_dict()).decode()
         return json.dumps(self.to_dict())
     
     @classmethod
-    def from_config_file(cls, config_file: str) -> "Settings":
+    def from_config_file(
+        cls,
+        config_file: str,
+        environ: Optional[Mapping[str, Optional[str]]] = None
+    ) -> "Settings":
         """Load settings from configuration file."""
         if not os.path.exists(config_file):
-            return cls()
+            return cls._from_env(environ)
         
-        with open(config_file, "r") as f:
-            config = json.load(f)
+        with open(config_file, "rb") as f:
+            data = f.read()
+        config = orjson.loads(data) if orjson is not None else json.loads(data)
         
-        return cls(**config)
+        return cls._from_env(environ, **config)
 
 
 @lru_cache()
@@ -87,10 +199,11 @@ def get_settings() -> Settings:
     
     This function is cached so that only one instance of Settings is created.
     """
-    config_file = os.environ.get("KAG_CONFIG_FILE", "config.json")
+    environ = _read_environ()
+    config_file = environ.get("KAG_CONFIG_FILE") or "config.json"
     if os.path.exists(config_file):
-        return Settings.from_config_file(config_file)
-    return Settings()
+        return Settings.from_config_file(config_file, environ)
+    return Settings._from_env(environ)
 
 
 def make_default_config_file(path: str = "config.json") -> None:
@@ -101,5 +214,10 @@ def make_default_config_file(path: str = "config.json") -> None:
         path: Path to the configuration file
     """
     settings = Settings()
+    if orjson is not None:
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(settings.to_dict(), option=orjson.OPT_INDENT_2))
+        return
+    
     with open(path, "w") as f:
-        f.write(settings.to_json()) 
\ No newline at end of file
+        f.write(json.dumps(settings.to_dict(), indent=2))
@@ -5,12 +5,18 @@ This module handles processing documents for the KAG system, including
 loading, chunking, and preparing documents for loading into KV cache.
 """
 
+import asyncio
 import base64
 import json
 import os
+import string
 import tempfile
+import threading
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Optional, Any, BinaryIO, Tuple
+from urllib.parse import urlparse
 
 import aiosqlite
 from langchain.text_splitter import RecursiveCharacterTextSplitter
@@ -23,6 +29,7 @@ from langchain.document_loaders import (
 )
 
 from kag.utils.logger import get_logger
+from kag.utils.token_counter import get_encoder
 from kag.config import get_settings
 
 # Initialize logger
@@ -31,6 +38,161 @@ logger = get_logger(__name__)
 # Get settings
 settings = get_settings()
 
+def _sqlite_path(database_url: str) -> str:
+    """
+    Derive the SQLite file path from a database URL.
+    
+    Follows the SQLAlchemy convention: sqlite:///kag.db is relative to the
+    working directory, sqlite:////var/lib/kag.db is absolute, and sqlite://
+    is an in-memory database.
+    
+    Args:
+        database_url: Database URL from settings
+        
+    Returns:
+        Path to pass to aiosqlite.connect
+    """
+    parsed = urlparse(database_url)
+    if parsed.scheme != "sqlite":
+        # Treat anything else as a plain file path
+        return database_url
+    
+    # Drop the single slash separating the empty host from the path
+    path = parsed.path[1:] if parsed.path.startswith("/") else parsed.path
+    return path or ":memory:"
+
+# Database path, resolved once per process
+_DB_PATH = _sqlite_path(settings.database_url)
+
+# Bounded pool for blocking parse work so it stays off the event loop
+_PARSE_EXECUTOR = ThreadPoolExecutor(
+    max_workers=os.cpu_count() or 1,
+    thread_name_prefix="kag-parse"
+)
+
+async def _run_blocking(func, *args):
+    """Run a blocking callable on the parse executor."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_PARSE_EXECUTOR, func, *args)
+
+# Characters stripped by the base64 probe; anything left over means "not base64".
+# Line breaks are allowed because MIME base64 is line-wrapped
+_BASE64_ALPHABET = str.maketrans("", "", string.ascii_letters + string.digits + "+/=\r\n")
+_BASE64_WHITESPACE = str.maketrans("", "", "\r\n")
+_BASE64_PROBE_LENGTH = 64
+
+def _base64_payload(document: str) -> Optional[str]:
+    """
+    Cheaply check whether a payload is plausibly base64 encoded.
+    
+    Only a short prefix is inspected, so mislabelled raw text is rejected
+    without running the decoder over the whole payload.
+    
+    Returns:
+        The payload with line breaks removed, or None if it is
+        not base64
+    """
+    if not document or document[:_BASE64_PROBE_LENGTH].translate(_BASE64_ALPHABET):
+        return None
+    
+    # Only copy the payload when it is actually line-wrapped
+    if "\n" in document or "\r" in document:
+        document = document.translate(_BASE64_WHITESPACE)
+    if not document or len(document) % 4:
+        return None
+    return document
+
+# Base64 characters decoded per write; a multiple of 4 so slices stay aligned
+_DECODE_SLICE = 64 * 1024
+
+def _write_upload_to_temp_file(document: str, suffix: str) -> str:
+    """
+    Write an uploaded document to a named temporary file.
+    
+    Base64 payloads are decoded slice by slice straight into the file, so the
+    fully decoded document is never held in memory alongside the upload.
+    
+    Args:
+        document: Base64 encoded document or raw text
+        suffix: Suffix for the temporary file name
+        
+    Returns:
+        Path of the temporary file
+    """
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as temp_file:
+        try:
+            payload = _base64_payload(document)
+            if payload is not None:
+                try:
+                    for start in range(0, len(payload), _DECODE_SLICE):
+                        temp_file.write(
+                            base64.b64decode(payload[start:start + _DECODE_SLICE], validate=True)
+                        )
+                    return temp_file.name
+                except ValueError:
+                    # binascii.Error for bad base64, plain ValueError for non-ASCII text
+                    # Not base64 after all; start over with the raw text
+                    temp_file.seek(0)
+                    temp_file.truncate()
+            
+            # If not base64, assume it's already decoded
+            temp_file.write(document.encode('utf-8'))
+            return temp_file.name
+        except BaseException:
+            temp_file.close()
+            os.unlink(temp_file.name)
+            raise
+
+# Explicit separators so the splitter never rebuilds its defaults per call
+_SEPARATORS = ["\n\n", "\n", ". ", "! ", "? ", " ", ""]
+
+# Per-thread memo of candidate chunk lengths, live only during _split_text
+_SPLIT_LENGTHS = threading.local()
+
+def _token_length(text: str) -> int:
+    """
+    Count tokens in a candidate chunk.
+    
+    The splitter measures the same sub-strings repeatedly while merging,
+    so lengths are memoized for the duration of one split. Special-token
+    text such as <|endoftext|> is counted as ordinary text rather than
+    rejected.
+    """
+    memo = getattr(_SPLIT_LENGTHS, "memo", None)
+    if memo is None:
+        return len(get_encoder().encode_ordinary(text))
+    
+    n = memo.get(text)
+    if n is None:
+        n = memo[text] = len(get_encoder().encode_ordinary(text))
+    return n
+
+def _split_text(text: str) -> List[str]:
+    """
+    Split text into chunks with the shared splitter.
+    
+    The length memo is dropped afterwards so document text is not kept
+    alive past the upload that produced it.
+    """
+    _SPLIT_LENGTHS.memo = {}
+    try:
+        return _TEXT_SPLITTER.split_text(text)
+    finally:
+        del _SPLIT_LENGTHS.memo
+
+def _count_chunk_tokens(chunks: List[str]) -> List[int]:
+    """Count tokens for each final chunk."""
+    encoder = get_encoder()
+    return [len(encoder.encode_ordinary(chunk)) for chunk in chunks]
+
+# Chunking settings are immutable, so one splitter serves every processor
+_TEXT_SPLITTER = RecursiveCharacterTextSplitter(
+    chunk_size=settings.chunk_size,
+    chunk_overlap=settings.chunk_overlap,
+    length_function=_token_length,
+    separators=_SEPARATORS
+)
+
 class DocumentProcessor:
     """
     Processes documents for the KAG system.
@@ -44,45 +206,89 @@ class DocumentProcessor:
     
     def __init__(self):
         """Initialize the document processor."""
-        self.db_path = settings.database_url.replace("sqlite:///", "")
+        self.db_path = _DB_PATH
         self.chunk_size = settings.chunk_size
         self.chunk_overlap = settings.chunk_overlap
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=self.chunk_size,
-            chunk_overlap=self.chunk_overlap,
-            length_function=len
-        )
+        self.text_splitter = _TEXT_SPLITTER
         
-        # Ensure database exists
-        self._create_tables_if_not_exist()
+        # Shared database connection, opened lazily by _conn()
+        self._db: Optional[aiosqlite.Connection] = None
+        self._db_lock = asyncio.Lock()
     
-    async def _create_tables_if_not_exist(self) -> None:
-        """Create database tables if they don't exist."""
-        async with aiosqlite.connect(self.db_path) as db:
-            # Create documents table
-            await db.execute("""
-            CREATE TABLE IF NOT EXISTS documents (
-                id TEXT PRIMARY KEY,
-                name TEXT NOT NULL,
-                type TEXT NOT NULL,
-                user_id TEXT NOT NULL,
-                created_at INTEGER NOT NULL
-            )
-            """)
-            
-            # Create document chunks table
-            await db.execute("""
-            CREATE TABLE IF NOT EXISTS document_chunks (
-                id TEXT PRIMARY KEY,
-                document_id TEXT NOT NULL,
-                chunk_index INTEGER NOT NULL,
-                content TEXT NOT NULL,
-                FOREIGN KEY (document_id) REFERENCES documents (id) ON DELETE CASCADE
-            )
-            """)
-            
-            await db.commit()
-            logger.debug("Database tables created if they didn't exist")
+    async def _conn(self) -> aiosqlite.Connection:
+        """
+        Get the shared database connection, opening it on first use.
+        
+        Callers must hold self._db_lock so that transactions on the shared
+        connection do not interleave.
+        
+        Returns:
+            The open database connection
+        """
+        if self._db is None:
+            db = await aiosqlite.connect(self.db_path)
+            # WAL + NORMAL sync keeps each commit to a single cheap fsync
+            await db.execute("PRAGMA journal_mode=WAL")
+            await db.execute("PRAGMA synchronous=NORMAL")
+            await db.execute("PRAGMA temp_store=MEMORY")
+            # Ensure tables exist before the connection is handed out
+            await self._create_tables_if_not_exist(db)
+            self._db = db
+        return self._db
+    
+    async def close(self) -> None:
+        """Close the shared database connection."""
+        async with self._db_lock:
+            if self._db is not None:
+                await self._db.close()
+                self._db = None
+                logger.debug("Database connection closed")
+    
+    async def _create_tables_if_not_exist(self, db: aiosqlite.Connection) -> None:
+        """
+        Create database tables if they don't exist.
+        
+        Called once from _conn() when the shared connection is opened.
+        
+        Args:
+            db: The newly opened database connection
+        """
+        # Create documents table
+        await db.execute("""
+        CREATE TABLE IF NOT EXISTS documents (
+            id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            type TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            created_at INTEGER NOT NULL
+        )
+        """)
+        
+        # Create document chunks table
+        await db.execute("""
+        CREATE TABLE IF NOT EXISTS document_chunks (
+            id TEXT PRIMARY KEY,
+            document_id TEXT NOT NULL,
+            chunk_index INTEGER NOT NULL,
+            content TEXT NOT NULL,
+            token_count INTEGER,
+            FOREIGN KEY (document_id) REFERENCES documents (id) ON DELETE CASCADE
+        )
+        """)
+        
+        # Add token_count to chunk tables created before it existed
+        cursor = await db.execute("PRAGMA table_info(document_chunks)")
+        columns = [row[1] for row in await cursor.fetchall()]
+        if "token_count" not in columns:
+            await db.execute("ALTER TABLE document_chunks ADD COLUMN token_count INTEGER")
+        
+        # Index for ordered chunk lookups by document
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_chunks_doc ON document_chunks (document_id, chunk_index)"
+        )
+        
+        await db.commit()
+        logger.debug("Database tables created if they didn't exist")
     
     async def process_document(
         self,
@@ -107,7 +313,7 @@ class DocumentProcessor:
         """
         # Generate document ID if not provided
         if not document_id:
-            document_id = str(uuid.uuid4())
+            document_id = uuid.uuid4().hex
         
         # Load document content based on type
         chunks = await self._load_and_chunk_document(document, document_type)
@@ -139,20 +345,13 @@ class DocumentProcessor:
             if document_type.lower() == "txt" or document_type.lower() == "text":
                 # Raw text
                 document_content = document
-                chunks = self.text_splitter.split_text(document_content)
+                chunks = await _run_blocking(_split_text, document_content)
             else:
                 # Binary document (PDF, DOCX, etc.)
-                # Try to decode base64
-                try:
-                    decoded_content = base64.b64decode(document)
-                except:
-                    # If not base64, assume it's already decoded
-                    decoded_content = document.encode('utf-8')
-                
-                # Create temporary file
-                with tempfile.NamedTemporaryFile(delete=False, suffix=f".{document_type.lower()}") as temp_file:
-                    temp_file.write(decoded_content)
-                    temp_path = temp_file.name
+                # Decode into a temporary file for the path-based loaders
+                temp_path = await _run_blocking(
+                    _write_upload_to_temp_file, document, f".{document_type.lower()}"
+                )
                 
                 # Process based on file type
                 try:
@@ -169,11 +368,11 @@ class DocumentProcessor:
                         loader = TextLoader(temp_path)
                     
                     # Load document
-                    documents = loader.load()
+                    documents = await _run_blocking(loader.load)
                     
                     # Combine and split text
                     combined_text = "\n\n".join([doc.page_content for doc in documents])
-                    chunks = self.text_splitter.split_text(combined_text)
+                    chunks = await _run_blocking(_split_text, combined_text)
                 finally:
                     # Clean up temporary file
                     if os.path.exists(temp_path):
@@ -204,30 +403,42 @@ class DocumentProcessor:
             user_id: ID of the user uploading the document
             chunks: List of document chunks
         """
-        import time
+        # Token counts are stored so KV cache loads can sum them instead of re-tokenizing
+        token_counts = await _run_blocking(_count_chunk_tokens, chunks)
         
-        async with aiosqlite.connect(self.db_path) as db:
-            # Store document
-            await db.execute(
-                "INSERT OR REPLACE INTO documents (id, name, type, user_id, created_at) VALUES (?, ?, ?, ?, ?)",
-                (document_id, document_name, document_type, user_id, int(time.time()))
-            )
-            
-            # Delete existing chunks if any
-            await db.execute(
-                "DELETE FROM document_chunks WHERE document_id = ?",
-                (document_id,)
-            )
-            
-            # Store chunks
-            for i, chunk in enumerate(chunks):
-                chunk_id = f"{document_id}_chunk_{i}"
+        prefix = document_id + "_chunk_"
+        rows = [
+            (prefix + str(i), document_id, i, chunk, token_count)
+            for i, (chunk, token_count) in enumerate(zip(chunks, token_counts))
+        ]
+        
+        async with self._db_lock:
+            db = await self._conn()
+            # Store document and chunks in one transaction
+            await db.execute("BEGIN")
+            try:
                 await db.execute(
-                    "INSERT INTO document_chunks (id, document_id, chunk_index, content) VALUES (?, ?, ?, ?)",
-                    (chunk_id, document_id, i, chunk)
+                    "INSERT OR REPLACE INTO documents (id, name, type, user_id, created_at) VALUES (?, ?, ?, ?, ?)",
+                    (document_id, document_name, document_type, user_id, int(time.time()))
                 )
-            
-            await db.commit()
+                
+                # Delete existing chunks if any
+                await db.execute(
+                    "DELETE FROM document_chunks WHERE document_id = ?",
+                    (document_id,)
+                )
+                
+                # Store chunks
+                await db.executemany(
+                    "INSERT INTO document_chunks (id, document_id, chunk_index, content, token_count) VALUES (?, ?, ?, ?, ?)",
+                    rows
+                )
+                
+                await db.commit()
+            except BaseException:
+                # Never leave the shared connection inside an open transaction
+                await db.rollback()
+                raise
             logger.info(f"Document {document_id} with {len(chunks)} chunks stored in database")
     
     async def get_document_chunks(
@@ -245,7 +456,8 @@ class DocumentProcessor:
         Returns:
             List of document chunks
         """
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._db_lock:
+            db = await self._conn()
             # Check if user has access to document
             if user_id:
                 cursor = await db.execute(
@@ -266,6 +478,36 @@ class DocumentProcessor:
             
             return [chunk[0] for chunk in chunks]
     
+    async def get_documents_token_count(self, document_ids: List[str]) -> Optional[int]:
+        """
+        Get the total stored token count for a set of documents.
+        
+        Args:
+            document_ids: IDs of the documents
+            
+        Returns:
+            Sum of chunk token counts, or None if any chunk has no stored count
+        """
+        if not document_ids:
+            return 0
+        
+        placeholders = ", ".join("?" for _ in document_ids)
+        async with self._db_lock:
+            db = await self._conn()
+            cursor = await db.execute(
+                f"""
+                SELECT SUM(token_count), COUNT(*) - COUNT(token_count)
+                FROM document_chunks
+                WHERE document_id IN ({placeholders})
+                """,
+                tuple(document_ids)
+            )
+            total, missing = await cursor.fetchone()
+        
+        if missing:
+            return None
+        return total or 0
+    
     async def get_user_documents(self, user_id: str) -> List[Dict[str, Any]]:
         """
         Get all documents for a user.
@@ -276,7 +518,8 @@ class DocumentProcessor:
         Returns:
             List of documents
         """
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._db_lock:
+            db = await self._conn()
             # Get documents
             cursor = await db.execute(
                 """
@@ -315,7 +558,8 @@ class DocumentProcessor:
         Returns:
             True if document was deleted, False otherwise
         """
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._db_lock:
+            db = await self._conn()
             # Check if user has access to document
             cursor = await db.execute(
                 "SELECT id FROM documents WHERE id = ? AND user_id = ?",
@@ -327,11 +571,16 @@ class DocumentProcessor:
                 return False
             
             # Delete document (will cascade to chunks)
-            await db.execute(
-                "DELETE FROM documents WHERE id = ?",
-                (document_id,)
-            )
-            
-            await db.commit()
+            try:
+                await db.execute(
+                    "DELETE FROM documents WHERE id = ?",
+                    (document_id,)
+                )
+                
+                await db.commit()
+            except BaseException:
+                # Never leave the shared connection inside an open transaction
+                await db.rollback()
+                raise
             logger.info(f"Document {document_id} deleted")
             return True 
\ No newline at end of file
@@ -6,8 +6,11 @@ documents into the KV cache and maintaining cache state across requests.
 """
 
 import asyncio
+import hashlib
 import json
 import time
+import weakref
+from collections import OrderedDict
 from typing import Dict, List, Optional, Any, Tuple
 
 import torch
@@ -25,6 +28,22 @@ logger = get_logger(__name__)
 # Get settings
 settings = get_settings()
 
+def _content_key(document_ids: List[str], user_id: str) -> bytes:
+    """
+    Compute the content key for a set of documents.
+    
+    Sessions loading the same documents for the same user share one KV cache.
+    
+    Args:
+        document_ids: List of document IDs
+        user_id: The ID of the user loading the documents
+        
+    Returns:
+        Digest identifying the document set
+    """
+    material = user_id + "\x00" + "|".join(sorted(set(document_ids)))
+    return hashlib.blake2b(material.encode("utf-8"), digest_size=16).digest()
+
 class KVCacheManager:
     """
     Manages KV cache operations for the KAG system.
@@ -33,13 +52,29 @@ class KVCacheManager:
     cache state across requests for different user sessions.
     """
     
-    def __init__(self):
-        """Initialize the KV cache manager."""
-        self.document_processor = DocumentProcessor()
-        self.session_kv_caches = {}  # Maps session_id to KV cache
+    def __init__(self, document_processor: Optional[DocumentProcessor] = None):
+        """
+        Initialize the KV cache manager.
+        
+        Args:
+            document_processor: Document processor to read chunks from; a new
+                one is created if not provided
+        """
+        self.document_processor = document_processor or DocumentProcessor()
+        self.session_kv_caches = OrderedDict()  # Maps session_id to KV cache, in LRU order
         self.session_document_map = {}  # Maps session_id to document_ids
         self.document_token_counts = {}  # Maps document_id to token count
-        self.lock = asyncio.Lock()
+        self._content_caches = {}  # Maps content key to [KV cache, refcount, token count]
+        self._session_cache_keys = {}  # Maps session_id to content key
+        self._key_aliases = {}  # Maps content key of a partly missing set to (content key, found document_ids)
+        self._cached_tokens = 0  # Total tokens held across all shared KV caches
+        self._total_docs_loaded = 0  # Sum of document counts across sessions
+        self.token_limit = settings.kv_cache_token_limit
+        # Per-session locks let different sessions load concurrently; entries
+        # disappear once no coroutine holds or awaits the lock
+        self._session_locks = weakref.WeakValueDictionary()  # Maps session_id to asyncio.Lock
+        # Guards the shared maps and the lock table; never held across I/O
+        self._map_lock = asyncio.Lock()
         
         # Will be initialized when connecting to the LLM engine
         self.llm_engine = None
@@ -63,41 +98,186 @@ class KVCacheManager:
             document_ids: List of document IDs to load
             user_id: The ID of the user making the request
         """
-        async with self.lock:
-            # Check if we already have these documents loaded
-            if session_id in self.session_document_map:
-                current_docs = self.session_document_map[session_id]
-                if set(current_docs) == set(document_ids):
-                    logger.info(f"Documents already loaded for session {session_id}")
-                    return
-            
-            # Get document chunks
-            document_chunks = []
-            for doc_id in document_ids:
-                chunks = await self.document_processor.get_document_chunks(doc_id, user_id)
-                if not chunks:
-                    logger.warning(f"Document {doc_id} not found or no chunks available")
-                    continue
-                document_chunks.extend(chunks)
+        async with await self._get_lock(session_id):
+            await self._load_documents(session_id, document_ids, user_id)
+    
+    async def _get_lock(self, session_id: str) -> asyncio.Lock:
+        """
+        Get the lock serialising KV cache loads for a session.
+        
+        Args:
+            session_id: The ID of the session
             
-            # If no chunks found, return early
-            if not document_chunks:
-                logger.warning("No document chunks found to load")
+        Returns:
+            The session's lock
+        """
+        async with self._map_lock:
+            lock = self._session_locks.get(session_id)
+            if lock is None:
+                lock = asyncio.Lock()
+                self._session_locks[session_id] = lock
+            return lock
+    
+    async def _load_documents(
+        self, 
+        session_id: str, 
+        document_ids: List[str],
+        user_id: str
+    ) -> None:
+        """
+        Load documents into a session's KV cache. Caller must hold the session lock.
+        
+        Args:
+            session_id: The ID of the session
+            document_ids: List of document IDs to load
+            user_id: The ID of the user making the request
+        """
+        # A set with missing documents resolves to the cache of those found
+        requested_key = _content_key(document_ids, user_id)
+        key, loaded_ids = self._key_aliases.get(requested_key, (requested_key, document_ids))
+        
+        # Check if we already have these documents loaded
+        if self._session_cache_keys.get(session_id) == key:
+            logger.info(f"Documents already loaded for session {session_id}")
+            return
+        
+        # Reuse a KV cache already built for the same documents by another session
+        async with self._map_lock:
+            key, loaded_ids = self._key_aliases.get(requested_key, (requested_key, document_ids))
+            if key in self._content_caches:
+                self._attach_session_cache(session_id, key, loaded_ids)
+                logger.info(f"Reusing shared KV cache for session {session_id}")
                 return
-            
-            # Create KV cache for documents
-            await self._create_kv_cache_for_documents(session_id, document_chunks)
-            
-            # Update session document map
-            self.session_document_map[session_id] = document_ids
-            
-            logger.info(f"Documents loaded for session {session_id}: {document_ids}")
+        
+        # Get document chunks outside the map lock; reads are serialized on the
+        # document processor's shared connection, so fetch them in turn
+        results = [
+            await self.document_processor.get_document_chunks(doc_id, user_id)
+            for doc_id in document_ids
+        ]
+        
+        document_chunks = []
+        found_ids = []
+        for doc_id, chunks in zip(document_ids, results):
+            if not chunks:
+                logger.warning(f"Document {doc_id} not found or no chunks available")
+                continue
+            document_chunks.extend(chunks)
+            found_ids.append(doc_id)
+        
+        # If no chunks found, return early
+        if not document_chunks:
+            logger.warning("No document chunks found to load")
+            return
+        
+        # Use token counts stored at ingestion time instead of re-tokenizing
+        token_count = await self.document_processor.get_documents_token_count(found_ids)
+        
+        # Create KV cache for documents
+        kv_cache, token_count = await self._create_kv_cache_for_documents(
+            session_id, document_chunks, token_count
+        )
+        
+        # Publish the cache under the documents it actually holds, so a set
+        # with missing documents is never stored under its full key; repeats
+        # of the requested set find it through an alias instead
+        key = _content_key(found_ids, user_id) if len(found_ids) != len(document_ids) else requested_key
+        
+        async with self._map_lock:
+            # Another session may have built the same cache meanwhile; keep the first
+            if key not in self._content_caches:
+                self._content_caches[key] = [kv_cache, 0, token_count]
+                self._cached_tokens += token_count
+            if key != requested_key:
+                self._key_aliases[requested_key] = (key, found_ids)
+            self._attach_session_cache(session_id, key, found_ids)
+            self._evict_over_limit(session_id)
+        
+        logger.info(f"Documents loaded for session {session_id}: {found_ids}")
+    
+    def _attach_session_cache(self, session_id: str, key: bytes, document_ids: List[str]) -> None:
+        """
+        Point a session at a shared KV cache. Caller must hold self._map_lock.
+        
+        Args:
+            session_id: The ID of the session
+            key: Content key of the shared KV cache
+            document_ids: List of document IDs in the cache
+        """
+        if self._session_cache_keys.get(session_id) != key:
+            self._release_session_cache(session_id)
+            self._content_caches[key][1] += 1
+            self._session_cache_keys[session_id] = key
+        
+        self.session_kv_caches[session_id] = self._content_caches[key][0]
+        self.session_kv_caches.move_to_end(session_id)
+        previous_docs = self.session_document_map.get(session_id)
+        if previous_docs is not None:
+            self._total_docs_loaded -= len(previous_docs)
+        self.session_document_map[session_id] = document_ids
+        self._total_docs_loaded += len(document_ids)
+    
+    def _release_session_cache(self, session_id: str) -> None:
+        """
+        Drop a session's reference to its shared KV cache. Caller must hold self._map_lock.
+        
+        The underlying cache is freed once no session references it.
+        
+        Args:
+            session_id: The ID of the session
+        """
+        key = self._session_cache_keys.pop(session_id, None)
+        if key is None:
+            return
+        
+        entry = self._content_caches[key]
+        entry[1] -= 1
+        if entry[1] <= 0:
+            del self._content_caches[key]
+            self._cached_tokens -= entry[2]
+            # Partial sets are rare, so a scan is cheaper than a reverse index
+            stale = [alias for alias, (target, _) in self._key_aliases.items() if target == key]
+            for alias in stale:
+                del self._key_aliases[alias]
+    
+    def _drop_session(self, session_id: str) -> None:
+        """
+        Remove a session's KV cache state. Caller must hold self._map_lock.
+        
+        Args:
+            session_id: The ID of the session
+        """
+        self._release_session_cache(session_id)
+        self.session_kv_caches.pop(session_id, None)
+        docs = self.session_document_map.pop(session_id, None)
+        if docs is not None:
+            self._total_docs_loaded -= len(docs)
+    
+    def _evict_over_limit(self, keep_session_id: str) -> None:
+        """
+        Evict least recently used sessions until cached tokens fit the limit.
+        
+        Caller must hold self._map_lock.
+        
+        Args:
+            keep_session_id: Session that must not be evicted (the one just loaded)
+        """
+        while self._cached_tokens > self.token_limit:
+            victim = next(
+                (sid for sid in self.session_kv_caches if sid != keep_session_id),
+                None
+            )
+            if victim is None:
+                break
+            self._drop_session(victim)
+            logger.info(f"Evicted KV cache for session {victim} to stay within token limit")
     
     async def _create_kv_cache_for_documents(
         self, 
         session_id: str, 
-        document_chunks: List[str]
-    ) -> None:
+        document_chunks: List[str],
+        token_count: Optional[int] = None
+    ) -> Tuple[Any, int]:
         """
         Create KV cache for document chunks.
         
@@ -107,17 +287,32 @@ class KVCacheManager:
         Args:
             session_id: The ID of the session
             document_chunks: List of document chunk texts
+            token_count: Precomputed token count for the chunks; counted from
+                the prompt when not provided
+            
+        Returns:
+            Tuple of the KV cache created for the documents and its token count
         """
         if not self.llm_engine:
             raise ValueError("LLM engine not connected")
         
-        # Combine chunks with separator
+        # Format the documents as a system message for processing
         # The format here depends on your model's preferences
+        # Wrapper and chunks are joined in a single pass so the document
+        # text is only copied once
         separator = "\n\n"
-        document_text = separator.join(document_chunks)
+        prompt_parts = ["<system>\nThe following are important documents to reference: "]
+        for chunk in document_chunks:
+            prompt_parts.append(chunk)
+            prompt_parts.append(separator)
+        if document_chunks:
+            prompt_parts.pop()
+        prompt_parts.append("\n</system>")
+        prompt = "".join(prompt_parts)
         
         # Count tokens for analytics
-        token_count = count_tokens(document_text)
+        if token_count is None:
+            token_count = count_tokens(prompt)
         logger.info(f"Loading {token_count} tokens into KV cache for session {session_id}")
         
         # Process document through model to generate KV cache
@@ -129,9 +324,6 @@ class KVCacheManager:
             kv_cache_mode="prefill_only"  # Special mode to only create KV cache
         )
         
-        # Format the document as a system message for processing
-        prompt = f"<system>\nThe following are important documents to reference: {document_text}\n</system>"
-        
         try:
             # Process through the model to create KV cache
             # In a real implementation, this would call the actual vLLM engine
@@ -148,11 +340,10 @@ class KVCacheManager:
             # Get the KV cache from results
             kv_cache = results.get("kv_cache")
             
-            # Store the KV cache for this session
-            self.session_kv_caches[session_id] = kv_cache
-            
             processing_time = time.time() - start_time
             logger.info(f"KV cache created in {processing_time:.2f}s for session {session_id}")
+            
+            return kv_cache, token_count
         
         except Exception as e:
             logger.error(f"Error creating KV cache: {str(e)}")
@@ -168,7 +359,12 @@ class KVCacheManager:
         Returns:
             The KV cache for the session, or None if not found
         """
-        return self.session_kv_caches.get(session_id)
+        if session_id not in self.session_kv_caches:
+            return None
+        
+        # Record recency for LRU eviction
+        self.session_kv_caches.move_to_end(session_id)
+        return self.session_kv_caches[session_id]
     
     async def clear_session_kv_cache(self, session_id: str) -> None:
         """
@@ -177,24 +373,29 @@ class KVCacheManager:
         Args:
             session_id: The ID of the session
         """
-        async with self.lock:
-            if session_id in self.session_kv_caches:
-                del self.session_kv_caches[session_id]
-            if session_id in self.session_document_map:
-                del self.session_document_map[session_id]
+        async with await self._get_lock(session_id):
+            async with self._map_lock:
+                self._drop_session(session_id)
             logger.info(f"Cleared KV cache for session {session_id}")
     
-    async def get_kv_cache_stats(self) -> Dict[str, Any]:
+    async def get_kv_cache_stats(self, detailed: bool = False) -> Dict[str, Any]:
         """
         Get statistics about the KV cache.
         
+        Args:
+            detailed: Whether to include the per-session document counts
+            
         Returns:
             Dictionary containing statistics about the KV cache
         """
-        return {
+        stats = {
             "active_sessions": len(self.session_kv_caches),
-            "total_documents_loaded": sum(len(docs) for docs in self.session_document_map.values()),
-            "session_document_counts": {
+            "total_documents_loaded": self._total_docs_loaded
+        }
+        
+        if detailed:
+            stats["session_document_counts"] = {
                 session_id: len(docs) for session_id, docs in self.session_document_map.items()
             }
-        } 
\ No newline at end of file
+        
+        return stats 
\ No newline at end of file
@@ -7,8 +7,11 @@ history and associating sessions with KV caches.
 
 import time
 import uuid
+from collections import OrderedDict
 from typing import Dict, List, Optional, Any, Tuple
 
+from readerwriterlock.rwlock import RWLockFair
+
 from kag.utils.logger import get_logger
 from kag.config import get_settings
 
@@ -29,6 +32,18 @@ class Session:
     - Associated document IDs
     """
     
+    __slots__ = (
+        "session_id",
+        "user_id",
+        "created_at",
+        "last_accessed_at",
+        "conversation_history",
+        "document_ids",
+        "_document_id_set",
+        "_dict_cache",
+        "_dict_dirty",
+    )
+    
     def __init__(self, session_id: str, user_id: str):
         """
         Initialize a new session.
@@ -43,6 +58,9 @@ class Session:
         self.last_accessed_at = time.time()
         self.conversation_history = []
         self.document_ids = []
+        self._document_id_set = set()  # Membership index for document_ids
+        self._dict_cache = None  # Last to_dict result
+        self._dict_dirty = True  # Whether _dict_cache is out of date
     
     def add_message(self, message: Dict[str, Any]) -> None:
         """
@@ -53,6 +71,20 @@ class Session:
         """
         self.conversation_history.append(message)
         self.last_accessed_at = time.time()
+        self._dict_dirty = True
+    
+    def extend_history(self, messages: List[Dict[str, Any]]) -> None:
+        """
+        Add several messages to the conversation history at once.
+        
+        Unlike repeated add_message calls, the access timestamp is updated once.
+        
+        Args:
+            messages: The messages to add
+        """
+        self.conversation_history.extend(messages)
+        self.last_accessed_at = time.time()
+        self._dict_dirty = True
     
     def add_documents(self, document_ids: List[str]) -> None:
         """
@@ -61,17 +93,29 @@ class Session:
         Args:
             document_ids: List of document IDs to associate
         """
-        self.document_ids.extend([doc_id for doc_id in document_ids if doc_id not in self.document_ids])
+        # dict.fromkeys drops duplicates in the input while keeping its order
+        known = self._document_id_set
+        new_ids = [doc_id for doc_id in dict.fromkeys(document_ids) if doc_id not in known]
+        known.update(new_ids)
+        self.document_ids.extend(new_ids)
         self.last_accessed_at = time.time()
+        self._dict_dirty = True
     
     def to_dict(self) -> Dict[str, Any]:
         """
         Convert session to dictionary.
         
+        The dictionary is cached and rebuilt only after messages or documents
+        change; the access timestamp is refreshed in place.
+        
         Returns:
             Dictionary representation of the session
         """
-        return {
+        if not self._dict_dirty:
+            self._dict_cache["last_accessed_at"] = self.last_accessed_at
+            return self._dict_cache
+        
+        self._dict_cache = {
             "session_id": self.session_id,
             "user_id": self.user_id,
             "created_at": self.created_at,
@@ -80,6 +124,8 @@ class Session:
             "document_count": len(self.document_ids),
             "document_ids": self.document_ids
         }
+        self._dict_dirty = False
+        return self._dict_cache
 
 
 class SessionManager:
@@ -88,13 +134,28 @@ class SessionManager:
     
     This class handles creating, retrieving, and managing user sessions.
     It also handles cleaning up expired sessions.
+    
+    Lookups take a shared read lock; anything that adds or removes sessions
+    takes the exclusive write lock.
     """
     
     def __init__(self):
         """Initialize the session manager."""
-        self.sessions = {}  # Maps session_id to Session
-        self.user_sessions = {}  # Maps user_id to list of session_ids
+        self.sessions = OrderedDict()  # Maps session_id to Session, least recently used first
+        self.user_sessions = {}  # Maps user_id to insertion-ordered dict of session_ids
         self.session_timeout = settings.session_timeout
+        self._rw = RWLockFair()
+        self._stats_cache = None  # Last get_stats result, cleared when sessions are added or removed
+        self._user_sessions_cache = {}  # Maps user_id to last get_user_sessions result
+    
+    def _invalidate_user(self, user_id: str) -> None:
+        """
+        Drop cached session listings affected by a change to a user's sessions.
+        
+        Args:
+            user_id: The user ID whose sessions changed
+        """
+        self._user_sessions_cache.pop(user_id, None)
     
     def get_or_create_session(self, session_id: str, user_id: str) -> Session:
         """
@@ -107,20 +168,22 @@ class SessionManager:
         Returns:
             The session
         """
-        # Check if session exists
-        if session_id in self.sessions:
-            session = self.sessions[session_id]
-            session.last_accessed_at = time.time()
-            return session
-        
-        # Create new session
-        session = Session(session_id, user_id)
-        self.sessions[session_id] = session
-        
-        # Associate session with user
-        if user_id not in self.user_sessions:
-            self.user_sessions[user_id] = []
-        self.user_sessions[user_id].append(session_id)
+        with self._rw.gen_wlock():
+            # Check if session exists
+            session = self._get_session_locked(session_id)
+            if session:
+                return session
+            
+            # Create new session
+            session = Session(session_id, user_id)
+            self.sessions[session_id] = session
+            
+            # Associate session with user
+            if user_id not in self.user_sessions:
+                self.user_sessions[user_id] = {}
+            self.user_sessions[user_id][session_id] = None
+            self._stats_cache = None
+            self._invalidate_user(user_id)
         
         logger.info(f"Created new session {session_id} for user {user_id}")
         return session
@@ -129,6 +192,19 @@ class SessionManager:
         """
         Get a session by ID.
         
+        Args:
+            session_id: The session ID
+            
+        Returns:
+            The session, or None if not found
+        """
+        with self._rw.gen_rlock():
+            return self._get_session_locked(session_id)
+    
+    def _get_session_locked(self, session_id: str) -> Optional[Session]:
+        """
+        Get a session by ID and mark it accessed. Caller must hold a lock.
+        
         Args:
             session_id: The session ID
             
@@ -140,6 +216,9 @@ class SessionManager:
         
         session = self.sessions[session_id]
         session.last_accessed_at = time.time()
+        # Keep sessions ordered by access so expiry scans can stop early;
+        # move_to_end is a single C call, safe under the read lock
+        self.sessions.move_to_end(session_id)
         return session
     
     def update_session(
@@ -156,17 +235,16 @@ class SessionManager:
             messages: The new messages
             response: The response
         """
-        session = self.get_session(session_id)
-        if not session:
-            logger.warning(f"Session {session_id} not found for update")
-            return
-        
-        # Add messages to conversation history
-        for message in messages:
-            session.add_message(message)
-        
-        # Add response to conversation history
-        session.add_message(response)
+        with self._rw.gen_wlock():
+            session = self._get_session_locked(session_id)
+            if not session:
+                logger.warning(f"Session {session_id} not found for update")
+                return
+            
+            # Add messages and response to conversation history
+            session.extend_history(messages)
+            session.add_message(response)
+            self._invalidate_user(session.user_id)
         
         logger.debug(f"Updated session {session_id} with {len(messages)} messages and response")
     
@@ -178,33 +256,45 @@ class SessionManager:
             session_id: The session ID
             document_ids: List of document IDs to associate
         """
-        session = self.get_session(session_id)
-        if not session:
-            logger.warning(f"Session {session_id} not found for document association")
-            return
+        with self._rw.gen_wlock():
+            session = self._get_session_locked(session_id)
+            if not session:
+                logger.warning(f"Session {session_id} not found for document association")
+                return
+            
+            session.add_documents(document_ids)
+            self._invalidate_user(session.user_id)
         
-        session.add_documents(document_ids)
         logger.debug(f"Associated documents {document_ids} with session {session_id}")
     
     def get_user_sessions(self, user_id: str) -> List[Dict[str, Any]]:
         """
         Get all sessions for a user.
         
+        The listing is cached until one of the user's sessions is created,
+        updated or deleted, so last_accessed_at may lag plain lookups.
+        
         Args:
             user_id: The user ID
             
         Returns:
             List of sessions for the user
         """
-        if user_id not in self.user_sessions:
-            return []
-        
-        user_session_ids = self.user_sessions[user_id]
-        user_sessions = [
-            self.sessions[session_id].to_dict() 
-            for session_id in user_session_ids 
-            if session_id in self.sessions
-        ]
+        with self._rw.gen_rlock():
+            if user_id not in self.user_sessions:
+                return []
+            
+            cached = self._user_sessions_cache.get(user_id)
+            if cached is not None:
+                return cached
+            
+            user_session_ids = self.user_sessions[user_id]
+            user_sessions = [
+                self.sessions[session_id].to_dict() 
+                for session_id in user_session_ids 
+                if session_id in self.sessions
+            ]
+            self._user_sessions_cache[user_id] = user_sessions
         
         return user_sessions
     
@@ -212,6 +302,23 @@ class SessionManager:
         """
         Delete a session.
         
+        Args:
+            session_id: The session ID
+            
+        Returns:
+            True if the session was deleted, False otherwise
+        """
+        with self._rw.gen_wlock():
+            deleted = self._delete_session_locked(session_id)
+        
+        if deleted:
+            logger.info(f"Deleted session {session_id}")
+        return deleted
+    
+    def _delete_session_locked(self, session_id: str) -> bool:
+        """
+        Delete a session. Caller must hold the write lock.
+        
         Args:
             session_id: The session ID
             
@@ -226,13 +333,12 @@ class SessionManager:
         
         # Remove session from user sessions
         if user_id in self.user_sessions:
-            if session_id in self.user_sessions[user_id]:
-                self.user_sessions[user_id].remove(session_id)
+            self.user_sessions[user_id].pop(session_id, None)
         
         # Remove session
         del self.sessions[session_id]
-        
-        logger.info(f"Deleted session {session_id}")
+        self._stats_cache = None
+        self._invalidate_user(user_id)
         return True
     
     def cleanup_expired_sessions(self) -> int:
@@ -242,15 +348,19 @@ class SessionManager:
         Returns:
             Number of expired sessions cleaned up
         """
-        now = time.time()
-        expired_sessions = [
-            session_id 
-            for session_id, session in self.sessions.items() 
-            if now - session.last_accessed_at > self.session_timeout
-        ]
-        
-        for session_id in expired_sessions:
-            self.delete_session(session_id)
+        # Sessions are in access order, so the scan stops at the first live
+        # one; scan and removal share one write-locked pass because lookups
+        # reorder the map
+        expired_sessions = []
+        with self._rw.gen_wlock():
+            now = time.time()
+            for session_id, session in self.sessions.items():
+                if now - session.last_accessed_at <= self.session_timeout:
+                    break
+                expired_sessions.append(session_id)
+            
+            for session_id in expired_sessions:
+                self._delete_session_locked(session_id)
         
         if expired_sessions:
             logger.info(f"Cleaned up {len(expired_sessions)} expired sessions")
@@ -264,11 +374,15 @@ class SessionManager:
         Returns:
             Dictionary containing statistics about sessions
         """
-        return {
-            "total_sessions": len(self.sessions),
-            "total_users": len(self.user_sessions),
-            "sessions_per_user": {
-                user_id: len(session_ids) 
-                for user_id, session_ids in self.user_sessions.items()
-            }
-        } 
\ No newline at end of file
+        with self._rw.gen_rlock():
+            # Counts only change when sessions are added or removed
+            if self._stats_cache is None:
+                self._stats_cache = {
+                    "total_sessions": len(self.sessions),
+                    "total_users": len(self.user_sessions),
+                    "sessions_per_user": {
+                        user_id: len(session_ids) 
+                        for user_id, session_ids in self.user_sessions.items()
+                    }
+                }
+            return self._stats_cache
\ No newline at end of file
@@ -5,16 +5,22 @@ This module initializes the vLLM engine and connects it with our KAG extensions
 to provide a complete Knowledge Augmented Generation system.
 """
 
-import argparse
 import asyncio
 import os
 import time
-import glob
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Optional, Any
 
 import uvicorn
 from fastapi import FastAPI, Depends, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, ORJSONResponse
+
+try:
+    import orjson  # noqa: F401 - required by ORJSONResponse
+except ImportError:  # pragma: no cover - orjson is optional
+    orjson = None
 
 # vLLM imports
 from vllm.engine.arg_utils import AsyncEngineArgs
@@ -23,9 +29,7 @@ from vllm.sampling_params import SamplingParams
 from vllm.entrypoints.openai.serving_chat import OpenAIServingChat
 
 # KAG imports
-from kag.kv_cache.manager import KVCacheManager
-from kag.kv_cache.session import SessionManager
-from kag.document_processor.processor import DocumentProcessor
+from kag.state import kv_cache_manager, session_manager, document_processor
 from kag.user.auth import setup_auth
 from kag.utils.logger import setup_logging, get_logger
 from kag.config import get_settings
@@ -38,16 +42,25 @@ settings = get_settings()
 setup_logging()
 logger = get_logger(__name__)
 
-# Initialize managers
-kv_cache_manager = KVCacheManager()
-session_manager = SessionManager()
-document_processor = DocumentProcessor()
+# Seconds between background sweeps for expired sessions
+SESSION_SWEEP_INTERVAL = 60
+
+# Maximum knowledge files ingested at once on startup
+KNOWLEDGE_INGEST_CONCURRENCY = 16
+
+# Dedicated pool for blocking file reads so knowledge ingestion does not
+# compete with request handling for the default executor
+_io_pool = ThreadPoolExecutor(
+    max_workers=min(32, (os.cpu_count() or 1) * 4),
+    thread_name_prefix="kag-io"
+)
 
 # Create FastAPI app
 app = FastAPI(
     title="KAG API",
     description="Knowledge Augmented Generation API",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse if orjson is not None else JSONResponse
 )
 
 # Get CORS settings
@@ -63,6 +76,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress larger JSON responses such as chat replies and session listings
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
 # Setup authentication
 setup_auth(app)
 
@@ -77,9 +93,9 @@ async def health_check():
 
 # Add KV cache stats route
 @app.get("/stats/kv_cache")
-async def kv_cache_stats():
+async def kv_cache_stats(detailed: bool = False):
     """Get KV cache statistics."""
-    return await kv_cache_manager.get_kv_cache_stats()
+    return await kv_cache_manager.get_kv_cache_stats(detailed=detailed)
 
 # Add session stats route
 @app.get("/stats/sessions")
@@ -87,6 +103,11 @@ async def session_stats():
     """Get session statistics."""
     return session_manager.get_stats()
 
+def _read_text_file(path: str) -> str:
+    """Read a UTF-8 text file."""
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
 async def load_knowledge_folder():
     """
     Load all Markdown files from kag/knowledge folder into the document database.
@@ -98,13 +119,13 @@ async def load_knowledge_folder():
     base_path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
     knowledge_path = os.path.join(base_path, "kag", "knowledge")
     
-    if not os.path.exists(knowledge_path):
+    # Get all markdown files
+    try:
+        md_files = [entry.path for entry in os.scandir(knowledge_path) if entry.name.endswith(".md")]
+    except FileNotFoundError:
         logger.warning(f"Knowledge folder not found: {knowledge_path}")
         return
     
-    # Get all markdown files
-    md_files = glob.glob(os.path.join(knowledge_path, "*.md"))
-    
     if not md_files:
         logger.warning("No markdown files found in knowledge folder")
         return
@@ -113,20 +134,21 @@ async def load_knowledge_folder():
     
     # Create a default session ID for the knowledge base
     kb_session_id = "knowledge_base_session"
-    document_ids = []
     
-    # Process each file
-    for md_file in md_files:
-        try:
-            # Get filename without extension
-            filename = os.path.basename(md_file)
-            document_name = os.path.splitext(filename)[0]
-            document_id = f"kb_{document_name}"
-            document_ids.append(document_id)
-            
-            # Read file content
-            with open(md_file, "r", encoding="utf-8") as f:
-                content = f.read()
+    # Bound concurrent ingestion so the tokenizer and database aren't flooded
+    semaphore = asyncio.Semaphore(KNOWLEDGE_INGEST_CONCURRENCY)
+    
+    async def process_file(md_file: str) -> str:
+        # Get filename without extension
+        filename = os.path.basename(md_file)
+        document_name = os.path.splitext(filename)[0]
+        document_id = f"kb_{document_name}"
+        
+        async with semaphore:
+            # Read file content off the event loop
+            content = await asyncio.get_running_loop().run_in_executor(
+                _io_pool, _read_text_file, md_file
+            )
             
             # Process document
             await document_processor.process_document(
@@ -136,11 +158,22 @@ async def load_knowledge_folder():
                 document_id=document_id,
                 user_id="system"
             )
-            
-            logger.info(f"Processed knowledge file: {filename}")
-            
-        except Exception as e:
-            logger.error(f"Error processing knowledge file {md_file}: {str(e)}")
+        
+        logger.info(f"Processed knowledge file: {filename}")
+        return document_id
+    
+    # Process all files concurrently
+    results = await asyncio.gather(
+        *(process_file(md_file) for md_file in md_files),
+        return_exceptions=True
+    )
+    
+    document_ids = []
+    for md_file, result in zip(md_files, results):
+        if isinstance(result, Exception):
+            logger.error(f"Error processing knowledge file {md_file}: {str(result)}")
+            continue
+        document_ids.append(result)
     
     # Load documents into KV cache
     if document_ids:
@@ -158,25 +191,14 @@ async def setup_vllm_engine():
     """Setup vLLM engine with KAG extensions."""
     logger.info("Setting up vLLM engine with KAG extensions...")
     
-    # Parse command line arguments
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--model", type=str, default=settings.model_path)
-    parser.add_argument("--tensor-parallel-size", type=int, default=settings.tensor_parallel_size)
-    parser.add_argument("--gpu-memory-utilization", type=float, default=settings.gpu_memory_utilization)
-    parser.add_argument("--max-model-len", type=int, default=settings.max_model_len)
-    parser.add_argument("--host", type=str, default=settings.host)
-    parser.add_argument("--port", type=int, default=settings.port)
-    parser.add_argument("--disable-custom-all-reduce", action="store_true", default=settings.disable_custom_all_reduce)
-    args = parser.parse_args()
-    
-    # Create engine arguments
+    # Create engine arguments from settings
     engine_args = AsyncEngineArgs(
-        model=args.model,
-        tensor_parallel_size=args.tensor_parallel_size,
-        gpu_memory_utilization=args.gpu_memory_utilization,
-        max_model_len=args.max_model_len,
+        model=settings.model_path,
+        tensor_parallel_size=settings.tensor_parallel_size,
+        gpu_memory_utilization=settings.gpu_memory_utilization,
+        max_model_len=settings.max_model_len,
         trust_remote_code=True,
-        disable_custom_all_reduce=args.disable_custom_all_reduce
+        disable_custom_all_reduce=settings.disable_custom_all_reduce
     )
     
     # Create engine
@@ -185,7 +207,7 @@ async def setup_vllm_engine():
     # Setup OpenAI-compatible chat endpoint with our extensions
     openai_serving_chat = OpenAIServingChat(
         engine=engine,
-        served_model=args.model
+        served_model=settings.model_path
     )
     
     # Register our vLLM hooks for KV cache access
@@ -201,7 +223,7 @@ async def setup_vllm_engine():
     
     logger.info("vLLM engine setup complete")
     
-    return args
+    return settings
 
 def register_vllm_hooks(engine):
     """
@@ -218,18 +240,46 @@ def register_vllm_hooks(engine):
     # engine.register_kv_cache_handler(kv_cache_manager.handle_kv_cache)
     pass
 
+async def _sweep_loop():
+    """Periodically remove expired sessions in the background."""
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        try:
+            session_manager.cleanup_expired_sessions()
+        except Exception as e:
+            logger.error(f"Error cleaning up expired sessions: {str(e)}")
+
 async def startup_event():
     """Startup event handler."""
-    args = await setup_vllm_engine()
-    logger.info(f"Starting server on {args.host}:{args.port}")
+    engine_settings = await setup_vllm_engine()
+    logger.info(f"Starting server on {engine_settings.host}:{engine_settings.port}")
     logger.info(f"CORS configured for origins: {cors_origins}")
     
     # Load knowledge files
-    await load_knowledge_folder()
+    if settings.load_knowledge_on_startup:
+        await load_knowledge_folder()
+    
+    # Start expired session sweeper
+    app.state.sweeper = asyncio.create_task(_sweep_loop())
 
 async def shutdown_event():
     """Shutdown event handler."""
     logger.info("Shutting down server...")
+    
+    # Stop expired session sweeper
+    sweeper = getattr(app.state, "sweeper", None)
+    if sweeper:
+        sweeper.cancel()
+        try:
+            await sweeper
+        except asyncio.CancelledError:
+            pass
+    
+    # Close database connection
+    await document_processor.close()
+    
+    # Stop file I/O workers
+    _io_pool.shutdown(wait=False)
 
 # Register startup and shutdown events
 app.add_event_handler("startup", startup_event)
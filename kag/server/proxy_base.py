@@ -0,0 +1,530 @@
+"""
+Shared core for the KAG proxy servers.
+
+This module holds everything the vLLM and Ollama proxies have in common:
+knowledge loading, the document context, the forwarding client and the
+FastAPI app factory. Each proxy only supplies how chat requests are rewritten.
+"""
+
+import asyncio
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Mapping, Optional, Tuple
+
+from fastapi import FastAPI, Request, Response, HTTPException
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+import httpx
+
+try:
+    import h2  # noqa: F401 - enables HTTP/2 in httpx
+    _HTTP2_AVAILABLE = True
+except ImportError:  # pragma: no cover - h2 is optional
+    _HTTP2_AVAILABLE = False
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is optional
+    orjson = None
+    import json
+
+from kag.utils.logger import get_logger
+
+# Initialize logger
+logger = get_logger("kag.proxy")
+
+# Get CORS settings
+cors_origins = os.environ.get("KAG_CORS_ORIGINS", "*").split(",")
+cors_allow_credentials = os.environ.get("KAG_CORS_ALLOW_CREDENTIALS", "true").lower() == "true"
+
+# Get external LLM URL
+external_llm_url = os.environ.get("KAG_EXTERNAL_LLM_URL", "http://localhost:11434")
+
+# Connection-level headers that must not be forwarded by a proxy
+_HOP_BY_HOP_HEADERS = frozenset({
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailers", "transfer-encoding", "upgrade"
+})
+
+# Request headers the forwarding client sets itself
+_REQUEST_EXCLUDED_HEADERS = _HOP_BY_HOP_HEADERS | {"host"}
+
+def _filter_headers(headers: Mapping[str, str], excluded: frozenset) -> Dict[str, str]:
+    """
+    Copy headers, dropping the excluded names.
+    
+    Args:
+        headers: Headers to copy
+        excluded: Lowercase header names to drop
+        
+    Returns:
+        Filtered headers
+    """
+    return {k: v for k, v in headers.items() if k.lower() not in excluded}
+
+# Upstream connection pool limits
+UPSTREAM_MAX_CONNECTIONS = 1000
+UPSTREAM_MAX_KEEPALIVE_CONNECTIONS = 200
+
+# Seconds idle upstream connections are kept open for reuse
+UPSTREAM_KEEPALIVE_EXPIRY = 75.0
+
+# Seconds to wait for upstream responses and for new connections
+UPSTREAM_TIMEOUT = 300.0
+UPSTREAM_CONNECT_TIMEOUT = 10.0
+
+# HTTP client for forwarding requests, created on startup
+http_client: Optional[httpx.AsyncClient] = None
+
+def _create_http_client() -> httpx.AsyncClient:
+    """
+    Create the client used to forward requests to the external LLM server.
+    
+    The pool is sized for high concurrency, and HTTP/2 is used when h2 is
+    installed so HTTPS upstreams can multiplex requests over few connections.
+    
+    Returns:
+        HTTP client
+    """
+    return httpx.AsyncClient(
+        base_url=external_llm_url,
+        http2=_HTTP2_AVAILABLE,
+        limits=httpx.Limits(
+            max_connections=UPSTREAM_MAX_CONNECTIONS,
+            max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY
+        ),
+        timeout=httpx.Timeout(UPSTREAM_TIMEOUT, connect=UPSTREAM_CONNECT_TIMEOUT)
+    )
+
+# Seconds an upstream health check result is reused
+HEALTH_CHECK_TTL = 2.0
+
+# Seconds to wait for the upstream health endpoint
+HEALTH_CHECK_TIMEOUT = 5.0
+
+# Seconds identical non-streaming chat responses are served from cache;
+# 0 disables the cache
+RESPONSE_CACHE_TTL = float(os.environ.get("KAG_CACHE_TTL", "0"))
+
+# Maximum number of cached responses
+RESPONSE_CACHE_SIZE = 1024
+
+# LRU of request hash -> (expires_at, status_code, body, headers)
+_response_cache: "OrderedDict[bytes, Tuple[float, int, bytes, Dict[str, str]]]" = OrderedDict()
+
+# Request headers identifying the caller; cached responses are only shared
+# between requests with the same values
+_IDENTITY_HEADERS = (
+    "authorization", "proxy-authorization", "cookie", "api-key", "x-api-key",
+    "openai-organization", "openai-project"
+)
+
+def _response_cache_key(url: str, headers: Mapping[str, str], body: bytes) -> bytes:
+    """
+    Hash an outgoing request into a response cache key.
+    
+    Caller identity headers are part of the key, so a cached response is
+    never served to a request with different credentials.
+    
+    Args:
+        url: Upstream request path
+        headers: Forwarded request headers
+        body: Final request body
+        
+    Returns:
+        Response cache key
+    """
+    lowered = {k.lower(): v for k, v in headers.items()}
+    digest = hashlib.sha256(url.encode("utf-8"))
+    for name in _IDENTITY_HEADERS:
+        digest.update(b"\0" + lowered.get(name, "").encode("utf-8"))
+    digest.update(b"\0" + body)
+    return digest.digest()
+
+def _get_cached_response(key: bytes) -> Optional[Response]:
+    """
+    Look up a cached upstream response.
+    
+    Args:
+        key: Response cache key
+        
+    Returns:
+        The cached response, or None if missing or expired
+    """
+    entry = _response_cache.get(key)
+    if entry is None:
+        return None
+    
+    expires_at, status_code, content, headers = entry
+    if expires_at < time.monotonic():
+        del _response_cache[key]
+        return None
+    
+    _response_cache.move_to_end(key)
+    return Response(content=content, status_code=status_code, headers=headers)
+
+def _cache_response(key: bytes, status_code: int, content: bytes, headers: Dict[str, str]) -> None:
+    """
+    Store an upstream response, evicting the least recently used when full.
+    
+    Args:
+        key: Response cache key
+        status_code: Response status code
+        content: Raw response body
+        headers: Response headers
+    """
+    _response_cache[key] = (time.monotonic() + RESPONSE_CACHE_TTL, status_code, content, headers)
+    _response_cache.move_to_end(key)
+    while len(_response_cache) > RESPONSE_CACHE_SIZE:
+        _response_cache.popitem(last=False)
+
+# Keep track of loaded documents
+loaded_documents = []
+
+def _json_loads(data: bytes) -> Any:
+    """Parse JSON from raw bytes."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def _json_dumps(data: Any) -> bytes:
+    """Serialize JSON to UTF-8 bytes."""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data).encode("utf-8")
+
+# Document context injected into chat requests, rebuilt when documents load
+_DOC_CONTEXT = ""
+
+# System message carrying the document context, shared by reference across
+# requests and never mutated
+_SYSTEM_MESSAGE: Dict[str, str] = {"role": "system", "content": ""}
+
+# Maximum characters of each document included in the context
+DOC_PREVIEW_CHARS = 1000
+
+def _build_doc_context(documents: List[Dict[str, Any]]) -> str:
+    """
+    Build the system prompt context from loaded documents.
+    
+    Args:
+        documents: Loaded documents
+        
+    Returns:
+        Document context string
+    """
+    return "The following documents contain important information:\n\n" + "".join(
+        f"Document: {doc['name']}\n{doc['preview']}\n\n" for doc in documents
+    )
+
+def _read_text_file(path: str) -> str:
+    """Read a UTF-8 text file, decoding it in one pass rather than through a text stream."""
+    with open(path, "rb") as f:
+        return f.read().decode("utf-8")
+
+async def load_knowledge_folder():
+    """
+    Load all Markdown files from kag/knowledge folder.
+    This ensures all knowledge is available for the KAG system on startup.
+    """
+    global loaded_documents, _DOC_CONTEXT, _SYSTEM_MESSAGE
+    
+    logger.info("Loading knowledge files from kag/knowledge folder...")
+    
+    # Get path to knowledge folder
+    base_path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    knowledge_path = os.path.join(base_path, "kag", "knowledge")
+    
+    # Get all markdown files in a single directory scan
+    try:
+        with os.scandir(knowledge_path) as it:
+            md_files = [
+                entry for entry in it
+                if entry.name.endswith(".md") and entry.is_file(follow_symlinks=False)
+            ]
+    except FileNotFoundError:
+        logger.warning(f"Knowledge folder not found: {knowledge_path}")
+        return
+    
+    if not md_files:
+        logger.warning("No markdown files found in knowledge folder")
+        return
+    
+    logger.info(f"Found {len(md_files)} markdown files in knowledge folder")
+    
+    # Read all files concurrently off the event loop
+    contents = await asyncio.gather(
+        *(asyncio.to_thread(_read_text_file, entry.path) for entry in md_files),
+        return_exceptions=True
+    )
+    
+    for entry, content in zip(md_files, contents):
+        if isinstance(content, Exception):
+            logger.error(f"Error loading knowledge file {entry.path}: {str(content)}")
+            continue
+        
+        # Add to loaded documents, named by filename without extension
+        loaded_documents.append({
+            "name": entry.name[:-3],
+            "content": content,
+            "preview": content[:DOC_PREVIEW_CHARS] + ("..." if len(content) > DOC_PREVIEW_CHARS else ""),
+            "path": entry.path
+        })
+        
+        logger.info(f"Loaded knowledge file: {entry.name}")
+    
+    # Documents don't change after loading, so build the context once
+    _DOC_CONTEXT = _build_doc_context(loaded_documents)
+    _SYSTEM_MESSAGE = {"role": "system", "content": _DOC_CONTEXT}
+    
+    logger.info(f"Loaded {len(loaded_documents)} knowledge documents")
+    logger.info("Documents are ready to be used in queries")
+
+def inject_document_context(messages: List[Dict[str, Any]]) -> None:
+    """
+    Add the document context to a chat message list in place.
+    
+    System messages come first by convention, so only the first message is
+    checked: an existing system message is extended, otherwise the shared
+    context message is prepended.
+    
+    Args:
+        messages: Chat messages to modify
+    """
+    if not loaded_documents:
+        return
+    
+    first = messages[0] if messages else None
+    content = first.get("content") if isinstance(first, dict) and first.get("role") == "system" else None
+    if isinstance(content, str):
+        # Append to existing system message
+        first["content"] = content + "\n\n" + _DOC_CONTEXT
+    elif isinstance(content, list):
+        # System message given as content parts; add the context as a text part
+        content.append({"type": "text", "text": _DOC_CONTEXT})
+    else:
+        # If no usable system message, add one
+        messages.insert(0, _SYSTEM_MESSAGE)
+
+# Rewrites a parsed chat request, returning the upstream path and new body
+ChatRequestConverter = Callable[[str, Any], Awaitable[Tuple[str, Any]]]
+
+def make_app(
+    llm_name: str,
+    health_path: str,
+    is_chat_request: Callable[[str], bool],
+    convert_chat_request: ChatRequestConverter,
+    forward_on_error: bool = False
+) -> FastAPI:
+    """
+    Create a proxy app that forwards requests to the external LLM server.
+    
+    Args:
+        llm_name: Display name of the external LLM server
+        health_path: Path of the external server's health endpoint
+        is_chat_request: Returns True for request paths whose JSON body
+            should be rewritten with convert_chat_request
+        convert_chat_request: Rewrites a parsed chat request body
+        forward_on_error: Forward chat requests that can't be parsed or
+            rewritten unmodified instead of rejecting them with a 400
+        
+    Returns:
+        FastAPI app
+    """
+    # Create FastAPI app
+    app = FastAPI(
+        title=f"KAG Proxy API for {llm_name}",
+        description=f"Knowledge Augmented Generation Proxy API for {llm_name}",
+        version="1.0.0"
+    )
+    
+    # Add CORS middleware
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=cors_origins,
+        allow_credentials=cors_allow_credentials,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+    
+    # Documents endpoint
+    @app.get("/documents")
+    async def list_documents():
+        """List loaded documents."""
+        return {
+            "count": len(loaded_documents),
+            "documents": [{"name": doc["name"], "path": doc["path"]} for doc in loaded_documents]
+        }
+    
+    # Most recent upstream health check, reused for HEALTH_CHECK_TTL seconds
+    health_state = {"checked_at": float("-inf"), "result": None}
+    
+    async def check_upstream() -> Dict[str, Any]:
+        """Check whether the external LLM server is reachable, with a short TTL cache."""
+        now = time.monotonic()
+        if health_state["result"] is not None and now - health_state["checked_at"] < HEALTH_CHECK_TTL:
+            return health_state["result"]
+        
+        try:
+            response = await http_client.get(health_path, timeout=HEALTH_CHECK_TIMEOUT)
+            
+            if response.status_code == 200:
+                result = {
+                    "status": "ok",
+                    "version": "1.0.0",
+                    "external_llm": "connected",
+                    "external_llm_url": external_llm_url,
+                    "loaded_documents": len(loaded_documents)
+                }
+            else:
+                result = {
+                    "status": "warning",
+                    "message": f"External LLM server returned status {response.status_code}",
+                    "external_llm_url": external_llm_url,
+                    "loaded_documents": len(loaded_documents)
+                }
+        except Exception as e:
+            result = {
+                "status": "warning",
+                "message": f"Error connecting to external LLM server: {str(e)}",
+                "external_llm_url": external_llm_url,
+                "loaded_documents": len(loaded_documents)
+            }
+        
+        health_state["checked_at"] = now
+        health_state["result"] = result
+        return result
+    
+    # Health check endpoint
+    @app.get("/health")
+    async def health_check():
+        """Health check endpoint that also checks the external LLM server."""
+        return await check_upstream()
+    
+    # Liveness endpoint
+    @app.get("/live")
+    async def liveness_check():
+        """Liveness check that never contacts the external LLM server."""
+        return {"status": "ok"}
+    
+    # Readiness endpoint
+    @app.get("/ready")
+    async def readiness_check():
+        """Readiness check that fails while the external LLM server is unreachable."""
+        result = await check_upstream()
+        status_code = 200 if result["status"] == "ok" else 503
+        return JSONResponse(content=result, status_code=status_code)
+    
+    # Proxy function
+    @app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "OPTIONS", "HEAD", "PATCH"])
+    async def proxy(request: Request, path: str):
+        """
+        Proxy all requests to the external LLM server while adding document context.
+        """
+        # Get target URL
+        url = f"/{path}"
+        
+        # Get forwardable headers
+        headers = _filter_headers(request.headers, _REQUEST_EXCLUDED_HEADERS)
+        
+        # Set for chat requests whose responses may be served from cache
+        cache_key = None
+        
+        try:
+            if is_chat_request(path):
+                # Only chat requests are modified, so only they are buffered
+                body = await request.body()
+                rewritten = False
+                
+                try:
+                    # Parse and rewrite the request body
+                    data = _json_loads(body)
+                    streaming = isinstance(data, dict) and bool(data.get("stream"))
+                    url, data = await convert_chat_request(url, data)
+                    body = _json_dumps(data)
+                    rewritten = True
+                except Exception as e:
+                    logger.error(f"Error converting request format: {str(e)}")
+                    if not forward_on_error:
+                        raise HTTPException(status_code=400, detail=f"Error converting request format: {str(e)}")
+                
+                # Let the client set the length of the rewritten body
+                if rewritten:
+                    headers.pop("content-length", None)
+                
+                # Serve repeated non-streaming requests from cache
+                if rewritten and RESPONSE_CACHE_TTL > 0 and not streaming:
+                    cache_key = _response_cache_key(url, headers, body)
+                    cached = _get_cached_response(cache_key)
+                    if cached is not None:
+                        return cached
+            elif "content-length" in request.headers or "transfer-encoding" in request.headers:
+                # Stream pass-through bodies to the server unchanged
+                body = request.stream()
+            else:
+                # Bodyless requests such as GET /v1/models must not be sent chunked
+                body = None
+            
+            logger.debug("Forwarding request to %s: %s", llm_name, url)
+            
+            # Forward the request to the external LLM server
+            upstream_request = http_client.build_request(
+                method=request.method,
+                url=url,
+                headers=headers,
+                content=body
+            )
+            response = await http_client.send(upstream_request, stream=True)
+            
+            # Buffer cacheable successful responses so repeats skip the server
+            if cache_key is not None and response.status_code == 200:
+                try:
+                    content = b"".join([chunk async for chunk in response.aiter_raw()])
+                finally:
+                    await response.aclose()
+                response_headers = _filter_headers(response.headers, _HOP_BY_HOP_HEADERS)
+                _cache_response(cache_key, response.status_code, content, response_headers)
+                return Response(content=content, status_code=response.status_code, headers=response_headers)
+            
+            # Stream the response back as it arrives; raw bytes keep any
+            # content-encoding intact for the forwarded headers
+            return StreamingResponse(
+                response.aiter_raw(),
+                status_code=response.status_code,
+                headers=_filter_headers(response.headers, _HOP_BY_HOP_HEADERS),
+                background=BackgroundTask(response.aclose)
+            )
+        
+        except HTTPException:
+            raise
+        except Exception as e:
+            logger.error(f"Error proxying request: {str(e)}")
+            raise HTTPException(status_code=500, detail=f"Error connecting to LLM server: {str(e)}")
+    
+    async def startup_event():
+        """Startup event handler that loads knowledge files."""
+        global http_client
+        
+        logger.info(f"Starting KAG proxy server connected to {llm_name} at {external_llm_url}")
+        
+        # Create the forwarding client inside the running event loop
+        http_client = _create_http_client()
+        
+        # Load knowledge files
+        await load_knowledge_folder()
+    
+    async def shutdown_event():
+        """Shutdown event handler."""
+        logger.info("Shutting down KAG proxy server...")
+        if http_client is not None:
+            await http_client.aclose()
+    
+    # Register startup and shutdown events
+    app.add_event_handler("startup", startup_event)
+    app.add_event_handler("shutdown", shutdown_event)
+    
+    return app
@@ -0,0 +1,15 @@
+"""
+Shared runtime state for the KAG system.
+
+This module holds the process-wide manager instances so that every server
+module works against the same sessions, KV caches and document database.
+"""
+
+from kag.document_processor.processor import DocumentProcessor
+from kag.kv_cache.manager import KVCacheManager
+from kag.kv_cache.session import SessionManager
+
+# Initialize managers
+document_processor = DocumentProcessor()
+kv_cache_manager = KVCacheManager(document_processor=document_processor)
+session_manager = SessionManager()
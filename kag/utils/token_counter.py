@@ -6,10 +6,17 @@ for managing KV cache usage and token limits.
 """
 
 import re
-from typing import Dict, List, Union, Any, Optional
+from functools import lru_cache
+from typing import Dict, List, Union, Any, Optional, Tuple
 
 import tiktoken
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is optional
+    orjson = None
+    import json
+
 from kag.utils.logger import get_logger
 from kag.config import get_settings
 
@@ -44,13 +51,80 @@ def get_encoder(model_name: str = None) -> tiktoken.Encoding:
         # Try to get encoding for a specific model
         enc = tiktoken.encoding_for_model(model_name)
     except KeyError:
-        # Fall back to cl100k_base
-        enc = tiktoken.get_encoding("cl100k_base")
+        # Fall back to cl100k_base, which is preloaded at import
+        enc = _ENCODERS.get("cl100k_base") or tiktoken.get_encoding("cl100k_base")
     
     # Cache encoder
     _ENCODERS[model_name] = enc
     return enc
 
+# Maximum number of memoized per-message token counts
+MESSAGE_TOKEN_CACHE_SIZE = 4096
+
+# Minimum uncached messages before contents are batch-encoded; tiktoken
+# starts a thread pool for every batch call
+BATCH_ENCODE_MIN_MESSAGES = 8
+
+# Threads tiktoken uses when batch-encoding message contents
+BATCH_ENCODE_THREADS = 4
+
+# Memoized message token counts keyed by (model_name, role, content, name);
+# cleared when full, since plain dict operations are thread-safe
+_MESSAGE_TOKENS: Dict[Tuple[Optional[str], str, str, str], int] = {}
+
+@lru_cache(maxsize=1024)
+def _encode_len(model_name: Optional[str], text: str) -> int:
+    """Count tokens in a short, frequently repeated string such as a role or name."""
+    return len(get_encoder(model_name).encode_ordinary(text))
+
+def _message_key(message: Dict[str, Any], model_name: Optional[str]) -> Tuple[Optional[str], str, str, str]:
+    """Build the memo key for the countable fields of a chat message."""
+    content = message.get("content", "")
+    if not isinstance(content, str):
+        content = ""
+    return (model_name, message.get("role", ""), content, message.get("name", "") or "")
+
+def _count_messages(keys: List[Tuple[Optional[str], str, str, str]], model_name: Optional[str]) -> List[int]:
+    """
+    Count tokens for messages by memo key, tokenizing only unseen messages.
+    
+    Args:
+        keys: Memo keys from _message_key
+        model_name: Name of the model to use for counting
+        
+    Returns:
+        Token count of each message
+    """
+    counts = {}
+    missing = []
+    for key in dict.fromkeys(keys):
+        n = _MESSAGE_TOKENS.get(key)
+        if n is None:
+            missing.append(key)
+        else:
+            counts[key] = n
+    
+    if missing:
+        encoder = get_encoder(model_name)
+        contents = [key[2] for key in missing]
+        if len(missing) >= BATCH_ENCODE_MIN_MESSAGES:
+            token_lists = encoder.encode_ordinary_batch(contents, num_threads=BATCH_ENCODE_THREADS)
+        else:
+            token_lists = [encoder.encode_ordinary(content) for content in contents]
+        
+        if len(_MESSAGE_TOKENS) + len(missing) > MESSAGE_TOKEN_CACHE_SIZE:
+            _MESSAGE_TOKENS.clear()
+        
+        for key, tokens in zip(missing, token_lists):
+            _, role, _, name = key
+            n = _encode_len(model_name, role) + len(tokens)
+            if name:
+                n += _encode_len(model_name, name)
+            counts[key] = n
+            _MESSAGE_TOKENS[key] = n
+    
+    return [counts[key] for key in keys]
+
 def count_tokens(text: Union[str, List[Dict[str, str]], Dict[str, Any]], model_name: str = None) -> int:
     """
     Count tokens in text.
@@ -67,30 +141,14 @@ def count_tokens(text: Union[str, List[Dict[str, str]], Dict[str, Any]], model_n
     
     # Handle different input types
     if isinstance(text, str):
-        # Count tokens for string
-        return len(encoder.encode(text))
+        # Count tokens for string; special-token text such as <|endoftext|>
+        # is counted as ordinary text, matching how chunks are counted
+        return len(encoder.encode_ordinary(text))
     elif isinstance(text, list):
-        # Assume list of messages
-        token_count = 0
-        
-        # Handle chat messages format
-        for message in text:
-            if not isinstance(message, dict):
-                continue
-            
-            # Count role
-            role = message.get("role", "")
-            token_count += len(encoder.encode(role))
-            
-            # Count content
-            content = message.get("content", "")
-            if isinstance(content, str):
-                token_count += len(encoder.encode(content))
-            
-            # Count name if present
-            name = message.get("name", "")
-            if name:
-                token_count += len(encoder.encode(name))
+        # Assume list of messages; count role, content and name of each,
+        # encoding unseen message contents together in one batch
+        keys = [_message_key(message, model_name) for message in text if isinstance(message, dict)]
+        token_count = sum(_count_messages(keys, model_name))
         
         # Add message format overhead
         token_count += 3  # Every message has a 3 token overhead
@@ -98,9 +156,11 @@ def count_tokens(text: Union[str, List[Dict[str, str]], Dict[str, Any]], model_n
         return token_count
     elif isinstance(text, dict):
         # Handle dictionary - serialize to string and count
-        import json
-        serialized = json.dumps(text)
-        return len(encoder.encode(serialized))
+        if orjson is not None:
+            serialized = orjson.dumps(text).decode()
+        else:
+            serialized = json.dumps(text)
+        return len(encoder.encode_ordinary(serialized))
     else:
         # Unknown type
         logger.warning(f"Unknown type for token counting: {type(text)}")
@@ -118,6 +178,11 @@ def truncate_text_to_token_limit(text: str, token_limit: int, model_name: str =
     Returns:
         Truncated text
     """
+    # Every token covers at least one UTF-8 byte, so text no longer in bytes
+    # than the limit fits without encoding it
+    if len(text) <= token_limit and len(text.encode("utf-8")) <= token_limit:
+        return text
+    
     # Get encoder
     encoder = get_encoder(model_name)
     
@@ -153,4 +218,22 @@ def estimate_token_limit_by_bytes(text: str, bytes_per_token: float = 4.0) -> in
     byte_length = len(text.encode("utf-8"))
     
     # Estimate token count
-    return int(byte_length / bytes_per_token) 
\ No newline at end of file
+    return int(byte_length / bytes_per_token) 
+
+def _preload_encoders() -> None:
+    """
+    Load the default encoder and any configured extras ahead of first use.
+    
+    Loading an encoding can fetch or parse its BPE file, which would otherwise
+    add latency to the first request that counts tokens.
+    """
+    model_names = ["cl100k_base"] + [
+        name.strip() for name in settings.preload_encoders.split(",") if name.strip()
+    ]
+    for model_name in model_names:
+        try:
+            get_encoder(model_name)
+        except Exception as e:
+            logger.warning(f"Could not preload tokenizer {model_name}: {str(e)}")
+
+_preload_encoders()